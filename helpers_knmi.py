@@ -4,6 +4,7 @@ Compacte KNMI Open Data API helper voor 48h-forecast samenvatting.
 - Probeert HARMONIE-AROME forecast te gebruiken (GRIB/NetCDF via Open Data API).
 - Vereist KNMI_API_KEY in st.secrets of omgeving.
 - Voor parsing van GRIB/NetCDF probeert hij xarray + cfgrib of netCDF4; bij ontbreken → return None.
+- Per instance wordt het bestand één keer gedownload en lokaal (gecachet) geopend.
 - Output (als het lukt):
   {
     "temp_min": float,
@@ -18,7 +19,9 @@ De aanroeper kan bij None gewoon fallbacken naar OpenWeather.
 
 from __future__ import annotations
 import os
-import io
+import hashlib
+import functools
+import tempfile
 import math
 import json
 import time
@@ -26,6 +29,7 @@ import typing as t
 from datetime import datetime, timedelta, timezone
 
 import requests
+from requests.adapters import HTTPAdapter
 
 # Dataset-namen wisselen soms; onderstaande zijn gangbare defaults
 DATASET_CANDIDATES = [
@@ -48,26 +52,35 @@ def _auth_header() -> dict:
     return {"Authorization": key}
 
 BASE = "https://api.dataplatform.knmi.nl/open-data/v1"
+_GRIB_SUFFIXES = (".grib2", ".grb2", ".grb")
+
+# Eén gedeelde sessie: keep-alive over de opeenvolgende API-calls (scheelt TLS-handshakes)
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=10))
 
 def _pick_latest_version(dataset: str) -> str | None:
-    """Haal de lijst versies op en pak de laatste (string)."""
+    """Haal de lijst versies op en pak de laatste (string); gecachet per dag."""
     try:
-        r = requests.get(f"{BASE}/datasets/{dataset}/versions", headers=_auth_header(), timeout=10)
-        if not r.ok:
-            return None
-        js = r.json()
-        versions = js.get("versions") or js.get("data") or js  # defensief
-        if isinstance(versions, list) and versions:
-            # Neem max volgens semver-achtige strings; anders eerste
-            return str(sorted(versions)[-1])
+        return _latest_version_cached(dataset, int(time.time() // 86400))
     except Exception:
         return None
-    return None
+
+@functools.lru_cache(maxsize=8)
+def _latest_version_cached(dataset: str, _day: int) -> str:
+    # Raise i.p.v. None bij falen: lru_cache slaat excepties niet op, dus een volgende call probeert opnieuw
+    r = _SESSION.get(f"{BASE}/datasets/{dataset}/versions", timeout=10)
+    r.raise_for_status()
+    js = r.json()
+    versions = js.get("versions") or js.get("data") or js  # defensief
+    if isinstance(versions, list) and versions:
+        # Neem max volgens semver-achtige strings; anders eerste
+        return str(sorted(versions)[-1])
+    raise ValueError(f"geen versies voor {dataset}")
 
 def _list_instances(dataset: str, version: str) -> list[dict]:
     try:
         url = f"{BASE}/datasets/{dataset}/versions/{version}/instances"
-        r = requests.get(url, headers=_auth_header(), timeout=15)
+        r = _SESSION.get(url, timeout=15)
         if not r.ok:
             return []
         js = r.json()
@@ -80,7 +93,7 @@ def _list_instances(dataset: str, version: str) -> list[dict]:
 def _list_files(dataset: str, version: str, instance_id: str) -> list[dict]:
     try:
         url = f"{BASE}/datasets/{dataset}/versions/{version}/instances/{instance_id}/files"
-        r = requests.get(url, headers=_auth_header(), timeout=15)
+        r = _SESSION.get(url, timeout=15)
         if not r.ok:
             return []
         js = r.json()
@@ -95,7 +108,7 @@ def _get_file_url(dataset: str, version: str, instance_id: str, filename: str) -
     """
     try:
         url = f"{BASE}/datasets/{dataset}/versions/{version}/instances/{instance_id}/files/{filename}/url"
-        r = requests.get(url, headers=_auth_header(), timeout=15)
+        r = _SESSION.get(url, timeout=15)
         if not r.ok:
             return None
         js = r.json()
@@ -111,52 +124,100 @@ def _find_candidate_file(files: list[dict]) -> dict | None:
     """
     if not files:
         return None
-    # Probeer GRIB2 eerst
+    # Eén pass met prioriteit: GRIB2 (0) > NetCDF (1) > rest; anders eerste
+    best_prio, best = 2, files[0]
     for f in files:
         name = f.get("filename","").lower()
-        if name.endswith(".grib2") or name.endswith(".grb2") or name.endswith(".grb"):
-            return f
-    # Dan NetCDF
-    for f in files:
-        name = f.get("filename","").lower()
-        if name.endswith(".nc"):
-            return f
-    # Anders eerste
-    return files[0]
+        prio = 0 if name.endswith(_GRIB_SUFFIXES) else 1 if name.endswith(".nc") else 2
+        if prio < best_prio:
+            best_prio, best = prio, f
+            if prio == 0:
+                break  # beter wordt het niet
+    return best
+
+_KEEP_FILES = 4  # gelijk aan maxsize van _open_ds_cached: oudere bestanden worden niet meer gebruikt
 
-def _try_parse_grib_or_netcdf_to_timeseries(content: bytes, lat: float, lon: float) -> dict | None:
+def _prune_old(directory: str, prefix: str, suffixes: tuple, sidecar: str | None = None) -> None:
+    """Houd alleen de _KEEP_FILES meest recente bestanden (plus sidecar) in `directory`."""
+    try:
+        paths = [os.path.join(directory, n) for n in os.listdir(directory)
+                 if n.startswith(prefix) and n.endswith(suffixes)]
+        paths.sort(key=os.path.getmtime, reverse=True)
+        for old in paths[_KEEP_FILES:]:
+            for p in (old, old + sidecar) if sidecar else (old,):
+                if os.path.exists(p):
+                    os.remove(p)
+    except Exception:
+        pass
+
+def _download_to_store(url: str, filename: str = "") -> str | None:
     """
-    Probeert met xarray + cfgrib (GRIB) of netCDF4/xarray (NetCDF) een 48h subset te lezen.
-    Berekent temp_min/max, neerslagsom, wind_max, ruwe pop (benadering).
-    Let op: vereist optionele libs; returnt None als parsing niet lukt.
+    Streamt de download in blokken naar disk (geen volledige bytes in geheugen) en
+    verplaatst hem atomair naar een vast pad op basis van de content-hash.
+    Zelfde inhoud → zelfde pad, zodat cfgrib zijn .idx-sidecar bij een volgende open hergebruikt.
+    """
+    name = (filename or "").lower()
+    suffix = ".nc" if name.endswith(".nc") else ".grib2"
+    tmpdir = tempfile.gettempdir()
+    digest = hashlib.blake2b(digest_size=16)
+    fd, tmp = tempfile.mkstemp(dir=tmpdir, suffix=".part")
+    try:
+        # pre-signed URL: geen Authorization-header meesturen
+        with os.fdopen(fd, "wb") as fh, \
+             _SESSION.get(url, headers={"Authorization": None}, stream=True, timeout=60) as resp:
+            resp.raise_for_status()
+            for chunk in resp.iter_content(256 * 1024):
+                digest.update(chunk)
+                fh.write(chunk)
+        path = os.path.join(tmpdir, f"knmi_{digest.hexdigest()}{suffix}")
+        if os.path.exists(path):
+            os.remove(tmp)
+            os.utime(path)  # recent gebruikt → niet opruimen
+        else:
+            os.replace(tmp, path)
+        _prune_old(tmpdir, "knmi_", (".grib2", ".nc"), sidecar=".idx")
+        return path
+    except Exception:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return None
+
+@functools.lru_cache(maxsize=4)
+def _open_ds_cached(path: str) -> tuple | None:
+    """
+    Opent het bestand één keer per unieke inhoud en resolvet de dure metadata:
+    (ds, lat_name, lon_name, tcoord, var_picks). None als openen/herkennen niet lukt.
     """
     try:
-        import numpy as np
         import xarray as xr
     except Exception:
         return None
 
-    # Heuristiek: eerst probeer GRIB via engine='cfgrib', anders standaard open_dataset (NC)
+    # Engine op basis van extensie: .nc direct als NetCDF, anders eerst cfgrib (met vaste .idx)
     ds = None
-    bio = io.BytesIO(content)
-    try:
-        import cfgrib  # noqa
+    if not path.endswith(".nc"):
         try:
-            ds = xr.open_dataset(bio, engine="cfgrib")
+            import cfgrib  # noqa
+            try:
+                ds = xr.open_dataset(path, engine="cfgrib",
+                                     backend_kwargs={"indexpath": path + ".idx"})
+            except Exception:
+                ds = None
         except Exception:
             ds = None
-    except Exception:
-        ds = None
 
     if ds is None:
-        # reset buffer en probeer netcdf
-        bio.seek(0)
+        # probeer netcdf
         try:
-            ds = xr.open_dataset(bio)
+            ds = xr.open_dataset(path)
         except Exception:
             return None
 
-    # Vind dichtstbijzijnde gridpunt
+    return _resolve_meta(ds)
+
+def _resolve_meta(ds) -> tuple | None:
+    """Coördinaat-, tijd- en variabelenamen bij een geopende dataset."""
+    # Coördinaatnamen voor het gridpunt
     lat_name = None
     lon_name = None
     for a in ["latitude","lat","gridlat","y"]:
@@ -176,23 +237,6 @@ def _try_parse_grib_or_netcdf_to_timeseries(content: bytes, lat: float, lon: flo
     if lat_name is None or lon_name is None:
         return None
 
-    # Zoek index van dichtsbijzijnde coördinaat
-    try:
-        lat_vals = ds[lat_name].values
-        lon_vals = ds[lon_name].values
-        # Ondersteun 1D of 2D grids
-        if lat_vals.ndim == 1 and lon_vals.ndim == 1:
-            lat_idx = (np.abs(lat_vals - lat)).argmin()
-            lon_idx = (np.abs(lon_vals - lon)).argmin()
-            indexer = {lat_name: lat_idx, lon_name: lon_idx}
-        else:
-            # 2D grid: neem totale min afstand
-            dist = (lat_vals - lat)**2 + (lon_vals - lon)**2
-            pos = np.unravel_index(np.nanargmin(dist), dist.shape)
-            indexer = {lat_name: pos[0], lon_name: pos[1]}
-    except Exception:
-        return None
-
     # Variabelen zoeken (namen verschillen per dataset)
     t2_candidates = ["t2m","t","2t","temperature","air_temperature_2m"]
     pr_candidates = ["tp","pr","precipitation","total_precipitation","apcp"]
@@ -200,37 +244,118 @@ def _try_parse_grib_or_netcdf_to_timeseries(content: bytes, lat: float, lon: flo
     v10_candidates= ["v10","v","10v"]
     wspd_candidates = ["wind_speed","wspd","ws"]
 
+    # Lowercase-namen eenmalig i.p.v. per kandidatenlijst
+    var_lower_items = [(str(v).lower(), v) for v in ds.data_vars]
+
     def _pick(name_list):
         for nm in name_list:
             if nm in ds:
                 return nm
         # Extra poging: zoek in data_vars op substring
-        for nm in ds.data_vars:
+        for lname, orig in var_lower_items:
             for k in name_list:
-                if k in nm.lower():
-                    return nm
+                if k in lname:
+                    return orig
         return None
 
-    t2 = _pick(t2_candidates)
-    pr = _pick(pr_candidates)
-    u10 = _pick(u10_candidates)
-    v10 = _pick(v10_candidates)
-    wspd = _pick(wspd_candidates)
+    var_picks = {
+        "t2": _pick(t2_candidates),
+        "pr": _pick(pr_candidates),
+        "u10": _pick(u10_candidates),
+        "v10": _pick(v10_candidates),
+        "wspd": _pick(wspd_candidates),
+    }
 
-    # Slice 48h venster vanaf "nu"
-    try:
-        tcoord = None
+    # Tijdcoördinaat
+    tcoord = None
+    for tcand in ["time","forecast_time","valid_time","t"]:
+        if tcand in ds.coords:
+            tcoord = tcand; break
+    if tcoord is None:
+        # soms in data_vars
         for tcand in ["time","forecast_time","valid_time","t"]:
-            if tcand in ds.coords:
+            if tcand in ds:
                 tcoord = tcand; break
-        if tcoord is None:
-            # soms in data_vars
-            for tcand in ["time","forecast_time","valid_time","t"]:
-                if tcand in ds:
-                    tcoord = tcand; break
-        if tcoord is None:
-            return None
 
+    return ds, lat_name, lon_name, tcoord, var_picks
+
+@functools.lru_cache(maxsize=64)
+def _nearest_idx(path: str, lat: float, lon: float) -> tuple[int, int] | None:
+    """Index (lat_idx, lon_idx) van het dichtstbijzijnde gridpunt; één keer per store."""
+    opened = _open_ds_cached(path)
+    if opened is None:
+        return None
+    ds, lat_name, lon_name = opened[:3]
+    return _nearest_pos(ds, lat_name, lon_name, lat, lon)
+
+def _nearest_1d(vals, target: float) -> int:
+    """Index van de dichtstbijzijnde waarde op een monotone 1D-as (binary search, O(log N))."""
+    import numpy as np
+
+    n = len(vals)
+    if n < 2:
+        return 0
+    rev = bool(vals[0] > vals[-1])  # aflopende as (bv. latitude N→Z)
+    if rev:
+        vals = vals[::-1]
+    i = int(np.clip(np.searchsorted(vals, target), 1, n - 1))
+    d_hi, d_lo = abs(vals[i] - target), abs(vals[i - 1] - target)
+    # bij gelijke afstand de laagste originele index (zoals argmin)
+    j = i if (d_hi <= d_lo if rev else d_hi < d_lo) else i - 1
+    return n - 1 - j if rev else j
+
+def _nearest_pos(ds, lat_name: str, lon_name: str, lat: float, lon: float) -> tuple[int, int] | None:
+    import numpy as np
+
+    try:
+        lat_vals = ds[lat_name].values
+        lon_vals = ds[lon_name].values
+        # Ondersteun 1D of 2D grids
+        if lat_vals.ndim == 1 and lon_vals.ndim == 1:
+            return _nearest_1d(lat_vals, lat), _nearest_1d(lon_vals, lon)
+        # 2D grid: neem totale min afstand
+        dist = (lat_vals - lat)**2 + (lon_vals - lon)**2
+        pos = np.unravel_index(np.nanargmin(dist), dist.shape)
+        return int(pos[0]), int(pos[1])
+    except Exception:
+        return None
+
+def _try_parse_grib_or_netcdf_to_timeseries(path: str, lat: float, lon: float) -> dict | None:
+    """
+    Probeert met xarray + cfgrib (GRIB) of netCDF4/xarray (NetCDF) een 48h subset te lezen.
+    Berekent temp_min/max, neerslagsom, wind_max, ruwe pop (benadering).
+    `path` is het lokale bestand uit _download_to_store; openen en metadata-scan
+    gebeuren één keer per unieke inhoud (zie _open_ds_cached).
+    Let op: vereist optionele libs; returnt None als parsing niet lukt.
+    """
+    # _open_ds_cached geeft None als xarray (en dus numpy) ontbreekt
+    opened = _open_ds_cached(path)
+    if opened is None:
+        return None
+
+    # Vind dichtstbijzijnde gridpunt
+    pos = _nearest_idx(path, float(lat), float(lon))
+    if pos is None:
+        return None
+    return _summarize(opened, pos)
+
+def _summarize(opened: tuple, pos: tuple[int, int]) -> dict | None:
+    """48h-samenvatting op gridpunt `pos` van een (ds, lat_name, lon_name, tcoord, var_picks)-tuple."""
+    import numpy as np
+
+    ds, lat_name, lon_name, tcoord, var_picks = opened
+    indexer = {lat_name: pos[0], lon_name: pos[1]}
+
+    t2 = var_picks["t2"]
+    pr = var_picks["pr"]
+    u10 = var_picks["u10"]
+    v10 = var_picks["v10"]
+    wspd = var_picks["wspd"]
+
+    # Slice 48h venster vanaf "nu"
+    if tcoord is None:
+        return None
+    try:
         # tijd index mask
         tvals = ds[tcoord].values
         now = np.datetime64(datetime.now(timezone.utc))
@@ -261,7 +386,8 @@ def _try_parse_grib_or_netcdf_to_timeseries(content: bytes, lat: float, lon: flo
                 total *= 1000.0
             out["rain_sum"] = total
             # crude POP: aandeel van stappen met >0.1mm
-            pop = float((arr > 0.1).sum()) / max(1, arr.size) * 100.0
+            hits = int(np.count_nonzero(arr > 0.1))
+            pop = hits / max(1, arr.size) * 100.0
             out["pop_max"] = int(round(pop))
     except Exception:
         pass
@@ -288,6 +414,9 @@ def _try_parse_grib_or_netcdf_to_timeseries(content: bytes, lat: float, lon: flo
     out.setdefault("first_desc", "")
     return out
 
+# instance_id → lokale kopie; zolang die bestaat gaat de (gecachete) lokale open voor
+_LOCAL_BY_INSTANCE: dict[str, str] = {}
+
 def fetch_knmi_48h_summary(lat: float, lon: float) -> dict | None:
     """
     Hoofd-helper: probeert KNMI HARMONIE te lezen en vertaalt naar compacte summary.
@@ -296,23 +425,20 @@ def fetch_knmi_48h_summary(lat: float, lon: float) -> dict | None:
     headers = _auth_header()
     if not headers:
         return None
+    # key per call op de sessie zetten: toegevoegd/geroteerd in secrets na start → meteen actief
+    _SESSION.headers.update(headers)
 
-    # Vind dataset + versie + laatste instance
-    dataset, version = None, None
+    # Vind dataset + versie + instances (één _list_instances per kandidaat)
+    dataset = version = instances = None
     for ds_name, ver in DATASET_CANDIDATES:
         v = ver or _pick_latest_version(ds_name)
-        if v is None:
-            v = _pick_latest_version(ds_name)
-        if v:
-            instances = _list_instances(ds_name, v)
-            if instances:
-                dataset, version = ds_name, v
-                break
-
-    if not dataset or not version:
-        return None
+        if not v:
+            continue
+        inst = _list_instances(ds_name, v)
+        if inst:
+            dataset, version, instances = ds_name, v, inst
+            break
 
-    instances = _list_instances(dataset, version)
     if not instances:
         return None
     # Neem laatste (meest recente)
@@ -321,6 +447,11 @@ def fetch_knmi_48h_summary(lat: float, lon: float) -> dict | None:
     if not instance_id:
         return None
 
+    # Lokale kopie van deze instance aanwezig → gecachete open, geen nieuwe download
+    local = _LOCAL_BY_INSTANCE.get(instance_id)
+    if local and os.path.exists(local):
+        return _try_parse_grib_or_netcdf_to_timeseries(local, lat, lon)
+
     files = _list_files(dataset, version, instance_id)
     if not files:
         return None
@@ -333,13 +464,11 @@ def fetch_knmi_48h_summary(lat: float, lon: float) -> dict | None:
     if not url:
         return None
 
-    # Download file in-memory (kan ~tientallen MB zijn)
-    try:
-        resp = requests.get(url, timeout=60)
-        resp.raise_for_status()
-        content = resp.content
-    except Exception:
+    # Download naar disk (kan ~tientallen MB zijn); gestreamd, niet in-memory
+    path = _download_to_store(url, filename)
+    if not path:
         return None
 
     # Parse naar summary
-    return _try_parse_grib_or_netcdf_to_timeseries(content, lat, lon)
+    _LOCAL_BY_INSTANCE[instance_id] = path
+    return _try_parse_grib_or_netcdf_to_timeseries(path, lat, lon)
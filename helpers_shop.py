@@ -25,6 +25,8 @@ SHOP_NAME_MAP_NORM: Dict[int, Dict[str, Any]] = _normalize(RAW_MAP)
 ID_TO_NAME: Dict[int, str] = {sid: v["name"] for sid, v in SHOP_NAME_MAP_NORM.items()}
 NAME_TO_ID: Dict[str, int] = {v["name"]: sid for sid, v in SHOP_NAME_MAP_NORM.items()}
 REGIONS: List[str] = sorted({v.get("region", "ALL") for v in SHOP_NAME_MAP_NORM.values()})
+ALL_SHOP_IDS: List[int] = list(ID_TO_NAME.keys())
+SORTED_STORE_NAMES: List[str] = sorted(ID_TO_NAME.values())
 
 def get_ids_by_region(region: str) -> List[int]:
     if region == "ALL":
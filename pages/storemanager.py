@@ -1,11 +1,18 @@
 # pages/01_Store_Live_Ops_with_Leaderboard_AI_Region.py
-import os, sys, math, json, re, datetime as dt
+import os, sys, math, json, re, tempfile, threading, datetime as dt
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import pytz
 import requests
+from requests.adapters import HTTPAdapter
 import numpy as np
 import pandas as pd
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+try:
+    from dogpile.cache import make_region   # optioneel: disk-cache voor externe signalen
+except Exception:
+    make_region = None
 
 # ───────────────────────── Page config ─────────────────────────
 st.set_page_config(page_title="Store Live Ops — Gisteren vs Eergisteren + Leaderboard",
@@ -14,7 +21,7 @@ st.title("🛍️ Store Live Ops — Gisteren vs Eergisteren + Leaderboard")
 
 # ───────────────────────── Imports / mapping ──────────────────────────────
 sys.path.append(os.path.abspath(os.path.dirname(__file__) + '/../'))
-from helpers_shop import ID_TO_NAME, NAME_TO_ID
+from helpers_shop import ID_TO_NAME, NAME_TO_ID, ALL_SHOP_IDS, SORTED_STORE_NAMES
 from shop_mapping import SHOP_NAME_MAP, get_postcode_by_id
 from helpers_normalize import normalize_vemcount_response
 from helpers_knmi import fetch_knmi_48h_summary
@@ -26,6 +33,46 @@ ECON_NEWS_RSS      = st.secrets.get("ECON_NEWS_RSS", "")
 HOLIDAYS_NL_ICS    = st.secrets.get("HOLIDAYS_NL_ICS_URL", "")
 CBS_CONFIDENCE_URL = st.secrets.get("CBS_CONFIDENCE_URL", "")
 
+# Gedeelde HTTP-sessie (keep-alive); cache_resource houdt hem vast over reruns heen
+@st.cache_resource
+def _http_session():
+    s=requests.Session()
+    adapter=HTTPAdapter(pool_connections=10, pool_maxsize=20)
+    s.mount("https://", adapter); s.mount("http://", adapter)
+    return s
+_SESSION=_http_session()
+
+# Disk-cache (L2) onder st.cache_data (L1): overleeft reruns én herstarts
+def _swr_runner(cache, somekey, creator, mutex):
+    """Stale-while-revalidate: geef de oude waarde direct terug, ververs op de achtergrond."""
+    def runner():
+        try:
+            cache.set(somekey, creator())
+        finally:
+            mutex.release()
+    threading.Thread(target=runner, daemon=True).start()
+
+@st.cache_resource
+def _disk_regions():
+    if make_region is None: return None, None
+    base=os.path.join(tempfile.gettempdir(), "retail_cache")
+    try:
+        region=make_region().configure("dogpile.cache.dbm", arguments={"filename":f"{base}.dbm"})
+        # zonder dogpile-lockfile: de mutex moet vanuit de refresh-thread vrijgegeven kunnen worden
+        swr=make_region(async_creation_runner=_swr_runner).configure(
+            "dogpile.cache.dbm", arguments={"filename":f"{base}_swr.dbm","dogpile_lockfile":False})
+        return region, swr
+    except Exception:
+        return None, None
+_DISK, _DISK_SWR = _disk_regions()
+
+# L1 boven de SWR-region kort houden, anders blijft de stale waarde nog een volle TTL in geheugen
+_SWR_L1_TTL = 120 if _DISK_SWR is not None else None
+
+def _disk_cached(region, ttl):
+    if region is None: return lambda fn: fn
+    return region.cache_on_arguments(expiration_time=ttl)
+
 # ───────────────────────── Kleuren & CSS ──────────────────────────────────
 PFM_RED="#F04438"; PFM_GREEN="#22C55E"; PFM_PURPLE="#6C4EE3"
 PFM_GRAY="#6B7280"; PFM_GRAY_BG="rgba(107,114,128,.10)"
@@ -62,7 +109,7 @@ if not NAME_TO_ID:
     st.error("Geen winkels geladen (NAME_TO_ID is leeg).")
     st.stop()
 
-store_options = sorted(ID_TO_NAME.values())
+store_options = SORTED_STORE_NAMES
 store_name    = st.selectbox("Kies winkel", store_options, index=0, key="store_pick")
 store_id      = NAME_TO_ID.get(store_name)
 if store_id is None: st.stop()
@@ -75,11 +122,17 @@ TZ = pytz.timezone("Europe/Amsterdam")
 TODAY = datetime.now(TZ).date()
 
 def add_effective_date(df: pd.DataFrame) -> pd.DataFrame:
-    d = df.copy()
-    if "date" not in d.columns: d["date"] = pd.NaT
-    ts = pd.to_datetime(d.get("timestamp"), errors="coerce")
-    d["date_eff"] = pd.to_datetime(d["date"], errors="coerce").fillna(ts)
-    return d
+    # in-place: normalize_json is eigenaar van de df, een kopie is overbodig
+    if "date" not in df.columns: df["date"] = pd.NaT
+    # alleen converteren wat nog geen datetime64 is
+    date = df["date"]
+    if not pd.api.types.is_datetime64_any_dtype(date):
+        date = pd.to_datetime(date, errors="coerce")
+    ts = df.get("timestamp")
+    if ts is not None and not pd.api.types.is_datetime64_any_dtype(ts):
+        ts = pd.to_datetime(ts, errors="coerce")
+    df["date_eff"] = date.fillna(ts) if ts is not None else date
+    return df
 
 def normalize_json(js, id_to_name, metrics):
     df = normalize_vemcount_response(js, id_to_name, kpi_keys=metrics)
@@ -89,33 +142,50 @@ def normalize_json(js, id_to_name, metrics):
     return df
 
 def post_report(params):
-    r = requests.post(API_URL, params=params, timeout=45)
+    r = _SESSION.post(API_URL, params=params, timeout=45)
     r.raise_for_status(); return r
 
-def fetch_df(shop_ids, period, step, metrics, label=""):
+def _report_params(shop_ids, period, step, metrics):
     params=[("data", sid) for sid in shop_ids]
     params+=[("data_output", m) for m in metrics]
     params+=[("source","shops"),("period",period),("step",step)]
-    resp=post_report(params); js=resp.json()
-    df=normalize_json(js, ID_TO_NAME, metrics)
-    return df, params, resp.status_code, {"label":label,"status":resp.status_code}
+    return params
+
+@st.cache_data(ttl=300, show_spinner=False)
+def _fetch_df_cached(shop_ids_t:tuple, period:str, step:str, metrics_t:tuple):
+    resp=post_report(_report_params(shop_ids_t, period, step, metrics_t))
+    return normalize_json(resp.json(), ID_TO_NAME, list(metrics_t)), resp.status_code
+
+def fetch_df(shop_ids, period, step, metrics, label=""):
+    # hashbare args → cache-hit over reruns (bv. alleen andere winkel gekozen)
+    df,status=_fetch_df_cached(tuple(shop_ids), period, step, tuple(metrics))
+    params=_report_params(shop_ids, period, step, metrics)
+    return df, params, status, {"label":label,"status":status}
 
 # ───────────────── External signals ──────────────────────────────
 @st.cache_data(ttl=900)
+@_disk_cached(_DISK, 900)
 def fetch_weather(pc4):
     if not OPENWEATHER_API_KEY or not pc4: return None
     try:
-        geo=requests.get("https://api.openweathermap.org/geo/1.0/zip",
+        geo=_SESSION.get("https://api.openweathermap.org/geo/1.0/zip",
                          params={"zip":f"{pc4},NL","appid":OPENWEATHER_API_KEY},timeout=8).json()
         lat,lon=geo.get("lat"),geo.get("lon")
-        fc=requests.get("https://api.openweathermap.org/data/2.5/forecast",
+        fc=_SESSION.get("https://api.openweathermap.org/data/2.5/forecast",
                         params={"lat":lat,"lon":lon,"units":"metric","appid":OPENWEATHER_API_KEY},timeout=8).json()
-        temps=[i["main"]["temp"] for i in fc["list"][:16]]
-        pops=[i.get("pop",0) for i in fc["list"][:16]]
-        return {"temp_min":min(temps),"temp_max":max(temps),"pop_max":max(pops)*100}
+        t_min=t_max=None; p_max=0.0   # één pass over de eerste 16 intervallen (48h)
+        for i in fc["list"][:16]:
+            t=i["main"]["temp"]
+            if t_min is None or t<t_min: t_min=t
+            if t_max is None or t>t_max: t_max=t
+            p=i.get("pop",0)
+            if p>p_max: p_max=p
+        if t_min is None: return None
+        return {"temp_min":t_min,"temp_max":t_max,"pop_max":p_max*100}
     except: return None
 
-@st.cache_data(ttl=3600)
+@st.cache_data(ttl=_SWR_L1_TTL or 3600)
+@_disk_cached(_DISK_SWR, 3600)
 def fetch_cbs_confidence():
     if not CBS_CONFIDENCE_URL: return None
     try:
@@ -127,7 +197,8 @@ def fetch_cbs_confidence():
                 "period": row.get("Periods")}
     except: return None
 
-@st.cache_data(ttl=1800)
+@st.cache_data(ttl=_SWR_L1_TTL or 1800)
+@_disk_cached(_DISK_SWR, 1800)
 def fetch_econ_news():
     if not ECON_NEWS_RSS: return []
     try:
@@ -136,24 +207,37 @@ def fetch_econ_news():
         return [re.sub("<.*?>","",t) for t in titles]
     except: return []
 
+# Per VEVENT-blok DTSTART + SUMMARY zoeken; volgorde van properties maakt niet uit
+_ICS_EVENT_RE = re.compile(rb"^BEGIN:VEVENT\r?$(.*?)^END:VEVENT", re.DOTALL | re.MULTILINE)
+_ICS_DTSTART_RE = re.compile(rb"^DTSTART[^:\r\n]*:(\d{8})", re.MULTILINE)
+_ICS_SUMMARY_RE = re.compile(rb"^SUMMARY[^:\r\n]*:([^\r\n]+)", re.MULTILINE)
+
 @st.cache_data(ttl=21600)
+@_disk_cached(_DISK, 21600)
 def fetch_holidays():
     if not HOLIDAYS_NL_ICS: return {}
     try:
-        lines=requests.get(HOLIDAYS_NL_ICS,timeout=6).text.splitlines()
-        out={}; cur={}
-        for ln in lines:
-            if ln.startswith("DTSTART"):
-                d=ln.split(":")[-1].strip(); cur["date"]=f"{d[:4]}-{d[4:6]}-{d[6:8]}"
-            elif ln.startswith("SUMMARY:"):
-                cur["summary"]=ln.split(":",1)[1]
-            elif ln.startswith("END:VEVENT") and "date" in cur:
-                out[cur["date"]]=cur["summary"]; cur={}
+        body=requests.get(HOLIDAYS_NL_ICS,timeout=6).content
+        out={}
+        for ev in _ICS_EVENT_RE.finditer(body):
+            dm=_ICS_DTSTART_RE.search(ev.group(1)); sm=_ICS_SUMMARY_RE.search(ev.group(1))
+            if dm and sm:
+                d=dm.group(1).decode(); out[f"{d[:4]}-{d[4:6]}-{d[6:8]}"]=sm.group(1).decode("utf-8","replace")
         return out
     except: return {}
 
+# ───────────────── Vemcount data (parallel) ──────────────────────
+# Drie onafhankelijke POSTs: wall-clock = traagste call i.p.v. de som
+all_ids=ALL_SHOP_IDS
+# workers krijgen de script-context mee, zodat st.cache_data in de threads zonder warnings werkt
+with ThreadPoolExecutor(max_workers=3, initializer=add_script_run_ctx,
+                        initargs=(None, get_script_run_ctx())) as ex:
+    f_cards=ex.submit(fetch_df,[store_id],"this_week","day",METRICS,"cards")
+    f_this =ex.submit(fetch_df,all_ids,"this_week","day",METRICS,"wtd")
+    f_last =ex.submit(fetch_df,all_ids,"last_week","day",METRICS,"wtd")
+(df_cards,*_),(df_this,*_),(df_last,*_)=f_cards.result(),f_this.result(),f_last.result()
+
 # ───────────────── Gisteren vs Eergisteren cards ─────────────────
-df_cards,_,_,_=fetch_df([store_id],"this_week","day",METRICS,"cards")
 df_cards=df_cards[df_cards["date_eff"].dt.date<TODAY]
 dates=sorted(df_cards["date_eff"].dt.date.unique())
 if len(dates)<2: st.stop()
@@ -162,13 +246,10 @@ gy=df_cards[df_cards["date_eff"].dt.date==ydate][METRICS].sum(numeric_only=True)
 gb=df_cards[df_cards["date_eff"].dt.date==bdate][METRICS].sum(numeric_only=True)
 
 # ───────────────── Leaderboard WTD ───────────────────────────────
-all_ids=list(ID_TO_NAME.keys())
-df_this,_,_,_=fetch_df(all_ids,"this_week","day",METRICS,"wtd")
-df_last,_,_,_=fetch_df(all_ids,"last_week","day",METRICS,"wtd")
-agg_this=df_this.groupby("shop_id",as_index=False).agg({"count_in":"sum","turnover":"sum"})
+df_this["_cw"]=df_this["conversion_rate"]*df_this["count_in"]   # gewogen conversie in één groupby-pass
+agg_this=df_this.groupby("shop_id",as_index=False).agg(count_in=("count_in","sum"),turnover=("turnover","sum"),_cw=("_cw","sum"))
 agg_this["sales_per_visitor"]=agg_this["turnover"]/agg_this["count_in"]
-conv=df_this.groupby("shop_id").apply(lambda x:(x["conversion_rate"]*x["count_in"]).sum()/x["count_in"].sum()).reset_index()
-conv.columns=["shop_id","conversion_rate"]; agg_this=agg_this.merge(conv,on="shop_id")
+agg_this["conversion_rate"]=agg_this["_cw"]/agg_this["count_in"]; agg_this=agg_this.drop(columns="_cw")
 agg_this["shop_name"]=agg_this["shop_id"].map(ID_TO_NAME)
 peer_conv_med=float(agg_this["conversion_rate"].median())
 peer_spv_med=float(agg_this["sales_per_visitor"].median())
@@ -179,10 +260,13 @@ cci=fetch_cbs_confidence()
 news=fetch_econ_news()
 hol=fetch_holidays().get(str(TODAY))
 
+# Compacte context (korte keys, afgeronde getallen) → minder prompt-tokens
 ai_context={
- "store":store_name,"yesterday":dict(gy),"day_before":dict(gb),
- "peer_median":{"conv":peer_conv_med,"spv":peer_spv_med},
- "weather":weather,"cci":cci,"news":news,"holiday":hol
+ "s":store_name,
+ "y":{k[:3]:round(float(v),2) for k,v in gy.items()},
+ "b":{k[:3]:round(float(v),2) for k,v in gb.items()},
+ "pm":{"cv":round(peer_conv_med,3),"spv":round(peer_spv_med,2)},
+ "w":weather,"c":cci,"n":[t[:80] for t in news[:3]],"h":hol
 }
 
 if OPENAI_API_KEY:
@@ -190,22 +274,35 @@ if OPENAI_API_KEY:
     client=OpenAI(api_key=OPENAI_API_KEY)
     sys_msg=("Je bent een retail coach. Geef 3 concrete acties "
              "(FTE, promo, coaching) obv cijfers, peers, weer, CCI, nieuws en vakanties. "
-             "Gebruik Nederlands, wees meetbaar (€X, Y%).")
-    usr_msg=f"Context:\n{json.dumps(ai_context,default=str)}"
-    try:
-        resp=client.chat.completions.create(
-            model="gpt-4o-mini",temperature=0.3,
-            messages=[{"role":"system","content":sys_msg},
-                      {"role":"user","content":usr_msg}]
-        )
-        insight=resp.choices[0].message.content
-        st.markdown(f"""
+             "Gebruik Nederlands, wees meetbaar (€X, Y%). "
+             "Context-keys: s=winkel, y=gisteren, b=eergisteren (cou=bezoekers, con=conversie %, "
+             "tur=omzet €, sal=besteding per bezoeker €), pm=peer-mediaan (cv=conversie, spv=SPV), "
+             "w=weer, c=consumentenvertrouwen CBS, n=nieuws, h=feestdag.")
+    usr_msg=f"Context:\n{json.dumps(ai_context,default=str,separators=(',',':'))}"
+    def render_ai_card(body):
+        placeholder.markdown(f"""
         <div class="ai-card">
           <div class="ai-title">🤖 AI-Advies</div>
           <div class="ai-caption">Gebaseerd op KPI’s, peers en externe signalen</div>
-          <div class="ai-body">{insight}</div>
+          <div class="ai-body">{body}</div>
         </div>
         """,unsafe_allow_html=True)
+    placeholder=st.empty()
+    try:
+        # Streamen: de kaart vult zich vanaf het eerste token i.p.v. na het volledige antwoord
+        stream=client.chat.completions.create(
+            model="gpt-4o-mini",temperature=0.3,
+            messages=[{"role":"system","content":sys_msg},
+                      {"role":"user","content":usr_msg}],
+            stream=True
+        )
+        full=[]
+        for chunk in stream:
+            if not chunk.choices: continue
+            delta=chunk.choices[0].delta.content or ""
+            if not delta: continue
+            full.append(delta)
+            render_ai_card("".join(full))
     except Exception as e:
         st.warning(f"AI niet geladen: {e}")
 else:
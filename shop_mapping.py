@@ -11,8 +11,12 @@ SHOP_NAME_MAP = {
     29691: {"name": "Tilburg",      "region": "Zuid NL",  "postcode": "5038"},
 }
 
+# 4-cijferige postcodes (letters gestript) eenmalig bij import; de map is statisch
+_POSTCODE_BY_ID = {
+    sid: "".join(ch for ch in str(v.get("postcode", "")) if ch.isdigit())[:4]
+    for sid, v in SHOP_NAME_MAP.items()
+}
+
 # Helper: haal 4-cijferige postcode op (letters worden gestript)
 def get_postcode_by_id(shop_id: int) -> str:
-    raw = str(SHOP_NAME_MAP.get(shop_id, {}).get("postcode", "")).strip()
-    digits = "".join(ch for ch in raw if ch.isdigit())
-    return digits[:4] if digits else ""
+    return _POSTCODE_BY_ID.get(shop_id, "")